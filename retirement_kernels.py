@@ -0,0 +1,47 @@
+"""
+Numba-compiled kernels for the retirement simulator.
+
+They live in their own module because Streamlit re-executes the app script on every rerun, while imported
+modules stay cached in sys.modules, so the kernels are compiled (or loaded from the disk cache) once per process.
+"""
+import numpy as np
+from numba import float64, njit, vectorize
+
+ZERO_RETURN_TOLERANCE = 1e-12  # Real returns smaller than this in magnitude are treated as zero
+
+
+@vectorize([float64(float64, float64, float64, float64)], nopython=True, fastmath=True, cache=True)
+def total_fv(current_savings, annual_savings, adjusted_return, years_to_invest):
+    """
+    Future value of current savings plus the annual savings annuity, fused into a single ufunc loop.
+    """
+    if abs(adjusted_return) < ZERO_RETURN_TOLERANCE:
+        # With no growth the annuity is just the sum of the contributions
+        return current_savings + annual_savings * years_to_invest
+    if adjusted_return > -1:
+        # (1 + r) ** n - 1 via expm1/log1p, which is cheaper and more accurate for small r
+        growth_m1 = np.expm1(years_to_invest * np.log1p(adjusted_return))
+    else:
+        growth_m1 = (1 + adjusted_return) ** years_to_invest - 1
+    return current_savings + current_savings * growth_m1 + annual_savings * (growth_m1 / adjusted_return)
+
+
+@njit(fastmath=True, cache=True)
+def mc_kernel(random_normals, proportion, expected_return, std_dev, current_savings, annual_savings,
+              inflation_rate, years_to_invest):
+    """
+    Evaluate total retirement savings for each row of standard normal draws in a single fused pass.
+    The loop is serial on purpose: Streamlit runs sessions in separate threads, and Numba's fallback
+    workqueue threading layer aborts the process when parallel kernels are entered concurrently.
+    The draws are float32 to halve their memory traffic; the returns and future values are computed in float64
+    so large balances neither overflow nor lose their cents.
+    """
+    num_simulations, num_assets = random_normals.shape
+    out = np.empty(num_simulations)
+    for i in range(num_simulations):
+        weighted_return = 0.0
+        for k in range(num_assets):
+            weighted_return += proportion[k] * (expected_return[k] + std_dev[k] * random_normals[i, k])
+        adjusted_return = (1 + weighted_return) / (1 + inflation_rate) - 1
+        out[i] = total_fv(current_savings, annual_savings, adjusted_return, years_to_invest)
+    return out
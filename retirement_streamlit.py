@@ -1,11 +1,27 @@
 
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
+
 import streamlit as st
 import numpy as np
-import matplotlib
 from matplotlib import pyplot as plt
 
+from retirement_kernels import ZERO_RETURN_TOLERANCE, mc_kernel, total_fv
+
+CACHE_MAX_ENTRIES = 32  # Upper bound on the entries kept by the Monte Carlo results cache
 
 
+@dataclass(slots=True, frozen=True)
+class Asset:
+    """
+    An asset in the portfolio with its share and return distribution.
+    """
+    name: str
+    proportion: float
+    expected_return: float
+    std_dev: float
+
 
 class RetirementPlan:
     """
@@ -14,7 +30,10 @@ class RetirementPlan:
     """
 
     def __init__(self, current_savings: float, annual_savings: float, inflation_rate: float, current_age: int,
-                 retirement_age: int):
+                 retirement_age: int, seed: Optional[int] = None):
+        """
+        Pass an explicit seed to make Monte Carlo simulations reproducible.
+        """
         self.current_savings = current_savings
         self.annual_savings = annual_savings
         self.inflation_rate = inflation_rate
@@ -22,48 +41,107 @@ class RetirementPlan:
         self.retirement_age = retirement_age
         self.years_to_invest = retirement_age - current_age
         self.assets = []
+        # Structure-of-arrays view of the asset fields used by the numeric code
+        self._props = np.empty(0)
+        self._mus = np.empty(0)
+        self._sigmas = np.empty(0)
+        self._rng = np.random.default_rng(seed)
 
     def add_assets(self, name: str, proportion: float, expected_return: float, std_dev: float):
         """
         Add an asset to the portfolio
         """
-        asset = {
-            'name': name,
-            'proportion': proportion,
-            'expected_return': expected_return,
-            'std_dev': std_dev
-        }
-        self.assets.append(asset)
+        self.assets.append(Asset(name, proportion, expected_return, std_dev))
+        self._props = np.append(self._props, proportion)
+        self._mus = np.append(self._mus, expected_return)
+        self._sigmas = np.append(self._sigmas, std_dev)
+        # Invalidate the cached properties that depend on the assets
+        self.__dict__.pop('_weighted_return', None)
+        self.__dict__.pop('_growth', None)
+
+    @property
+    def inflation_rate(self) -> float:
+        """
+        The annual inflation rate; setting it clears the cached values that depend on it
+        """
+        return self._inflation_rate
+
+    @inflation_rate.setter
+    def inflation_rate(self, value: float):
+        self._inflation_rate = value
+        # Invalidate the cached properties that depend on the inflation rate
+        self.__dict__.pop('_inv_one_plus_infl', None)
+        self.__dict__.pop('_weighted_return', None)
+        self.__dict__.pop('_growth', None)
+
+    @property
+    def years_to_invest(self) -> int:
+        """
+        The investment horizon in years; setting it clears the cached growth factor
+        """
+        return self._years_to_invest
+
+    @years_to_invest.setter
+    def years_to_invest(self, value: int):
+        self._years_to_invest = value
+        # Invalidate the cached growth factor, which depends on the investment horizon
+        self.__dict__.pop('_growth', None)
+
+    @cached_property
+    def _inv_one_plus_infl(self) -> float:
+        """
+        The inflation discount factor 1 / (1 + inflation rate)
+        """
+        return 1.0 / (1.0 + self.inflation_rate)
 
     def adjusted_return(self, rate: float) -> float:
         """
         Adjust the asset return for inflation
         """
-        adjusted_return = (1 + rate) / (1 + self.inflation_rate) - 1
+        adjusted_return = rate * self._inv_one_plus_infl + (self._inv_one_plus_infl - 1)
         return adjusted_return
 
+    @cached_property
+    def _weighted_return(self) -> float:
+        """
+        The inflation-adjusted weighted return, cached until the assets or the inflation rate change
+        """
+        # Both operands are already ndarrays, so no list-to-array conversion happens here. For a handful
+        # of assets the call overhead dominates the multiply-adds, which is why the result is cached.
+        return self.adjusted_return(self._props @ self._mus)
+
     def calculate_weighted_return(self) -> float:
         """
-        Calculate the weighted return of the portfolio
+        Calculate the weighted return of the portfolio.
+        The result is cached until the assets or the inflation rate change.
+        """
+        return self._weighted_return
+
+    @cached_property
+    def _growth(self) -> tuple:
+        """
+        The weighted return and the growth factor over the investment horizon
         """
-        proportion = [asset['proportion'] for asset in self.assets]
-        expected_return = [asset['expected_return'] for asset in self.assets]
-        weighted_return = np.dot(proportion, expected_return)
-        return self.adjusted_return(weighted_return)
+        weighted_return = self._weighted_return
+        return weighted_return, (1 + weighted_return) ** self.years_to_invest
 
     def future_value_current_savings(self) -> float:
         """
         Calculate the future value of current savings
         """
-        fv_current_savings = self.current_savings * (1 + self.calculate_weighted_return()) ** self.years_to_invest
+        _, growth_factor = self._growth
+        fv_current_savings = self.current_savings * growth_factor
         return fv_current_savings
 
     def future_value_annuity(self) -> float:
         """
         Calculate the future value of the annual savings (annuity).
         """
-        weighted_return = self.calculate_weighted_return()
-        fva = self.annual_savings * (((1 + weighted_return) ** self.years_to_invest - 1) / weighted_return)
+        weighted_return, growth_factor = self._growth
+        if abs(weighted_return) < ZERO_RETURN_TOLERANCE:
+            # With no growth the annuity is just the sum of the contributions
+            return float(self.annual_savings * self.years_to_invest)
+        fva = self.annual_savings * ((growth_factor - 1) / weighted_return)
         return fva
 
     def calculate_total_retirement_savings(self, tax_rate: float = 0.0) -> tuple:
@@ -80,51 +158,58 @@ class RetirementPlan:
         """
         Print a summary of the retirement plan details.
         """
-        st.write("\n**Retirement Plan Summary:**")
-        st.write(f"Current Age: {self.current_age}")
-        st.write(f"Retirement Age: {self.retirement_age}")
-        st.write(f"Portfolio Return: {self.calculate_weighted_return() * 100:.2f}%")
-        st.write(f"Years to Invest: {self.years_to_invest}")
-        st.write(f"Current savings: ${self.current_savings:.2f}")
-        st.write(f"Annual savings: ${self.annual_savings:.2f}")
-        st.write("\n**Assets:**")
-        for asset in self.assets:
-            st.write(
-                f" - {asset['name']}: {asset['proportion'] * 100:.2f}% of portfolio, Expected Return: {asset['expected_return'] * 100:.2f}%, Standard Deviation: {asset['std_dev']:.2f}")
-
-    def monte_carlo_simulation(self, num_simulations: int = 10000) -> list:
+        # Send the summary as one markdown message; dollar signs are escaped so they are not rendered as math
+        asset_lines = "\n".join(
+            f"- {asset.name}: {asset.proportion * 100:.2f}% of portfolio, "
+            f"Expected Return: {asset.expected_return * 100:.2f}%, Standard Deviation: {asset.std_dev:.2f}"
+            for asset in self.assets)
+        st.markdown(
+            "**Retirement Plan Summary:**\n\n"
+            f"- Current Age: {self.current_age}\n"
+            f"- Retirement Age: {self.retirement_age}\n"
+            f"- Portfolio Return: {self.calculate_weighted_return() * 100:.2f}%\n"
+            f"- Years to Invest: {self.years_to_invest}\n"
+            f"- Current savings: \\${self.current_savings:.2f}\n"
+            f"- Annual savings: \\${self.annual_savings:.2f}\n\n"
+            "**Assets:**\n\n"
+            f"{asset_lines}")
+
+    def monte_carlo_simulation(self, num_simulations: int = 10000) -> np.ndarray:
         """
         Perform Monte Carlo simulations to project the future value of retirement savings.
+        Random returns are drawn in one batch and evaluated by a compiled kernel.
         """
-        total_savings_retirement = []
-
-        # Loop through many simulations
-        for i in range(num_simulations):
-            random_returns = [
-                np.random.normal(asset['expected_return'], asset['std_dev'])
-                for asset in self.assets
-            ]
-            weighted_return = np.dot([asset['proportion'] for asset in self.assets], random_returns)
-            adjusted_return = self.adjusted_return(weighted_return)
-            future_value_current = self.current_savings * (1 + adjusted_return) ** self.years_to_invest
-            future_value_annuity = self.annual_savings * (
-                        ((1 + adjusted_return) ** self.years_to_invest - 1) / adjusted_return)
-            total_savings = future_value_current + future_value_annuity
-            total_savings_retirement.append(total_savings)
+        # One row of random asset returns per simulation
+        random_normals = self._rng.standard_normal((num_simulations, len(self.assets)), dtype=np.float32)
+        total_savings_retirement = mc_kernel(random_normals, self._props, self._mus, self._sigmas,
+                                             float(self.current_savings), float(self.annual_savings),
+                                             float(self.inflation_rate), float(self.years_to_invest))
 
         return total_savings_retirement
 
-    def monte_carlo_summary(self, num_simulations: int = 10000):
+    def monte_carlo_summary(self, num_simulations: int = 10000, outcomes: Optional[np.ndarray] = None):
         """
-        Run a Monte Carlo simulation and display a summary of results
+        Run a Monte Carlo simulation and display a summary of results.
+        Previously simulated outcomes can be passed in to skip the simulation.
         """
-        outcomes = self.monte_carlo_simulation(num_simulations)
-        st.write("\n**Monte Carlo Simulation Results**")
-        st.write(f"Mean Savings: ${np.mean(outcomes):.2f}")
-        st.write(f"Median Savings: ${np.median(outcomes):.2f}")
-        st.write(f"Standard Deviation: ${np.std(outcomes):.2f}")
-        st.write(f"Best Case (95th percentile): ${np.percentile(outcomes, 95):.2f}")
-        st.write(f"Worst Case (5th percentile): ${np.percentile(outcomes, 5):.2f}")
+        if outcomes is None:
+            outcomes = self.monte_carlo_simulation(num_simulations)
+
+        # 5th, 50th and 95th percentiles from a single O(n) partition, interpolated like np.percentile
+        positions = np.array([0.05, 0.5, 0.95]) * (len(outcomes) - 1)
+        lower = np.floor(positions).astype(int)
+        upper = np.ceil(positions).astype(int)
+        partitioned = np.partition(outcomes, np.union1d(lower, upper))
+        fraction = positions - lower
+        worst_case, median, best_case = partitioned[lower] + (partitioned[upper] - partitioned[lower]) * fraction
+
+        st.markdown(
+            "**Monte Carlo Simulation Results**\n\n"
+            f"- Mean Savings: \\${outcomes.mean():.2f}\n"
+            f"- Median Savings: \\${median:.2f}\n"
+            f"- Standard Deviation: \\${outcomes.std():.2f}\n"
+            f"- Best Case (95th percentile): \\${best_case:.2f}\n"
+            f"- Worst Case (5th percentile): \\${worst_case:.2f}")
 
     def calculate_principal(self):
         """
@@ -190,10 +275,9 @@ class RothRetirementPlan(RetirementPlan):
 
 def get_user_input():
     """
-    Collecting user input via Streamlit
+    Collecting user input via Streamlit.
+    The inputs are gathered in a form, so the plan is only recomputed once the user submits it.
     """
-    current_savings = st.number_input("Enter current savings:", min_value=0.0, format="%.2f")
-
     # Plan selection to determine the contribution limit
     plan_type = st.selectbox(
         "Select retirement plan type:",
@@ -207,47 +291,84 @@ def get_user_input():
         max_contribution = float('inf')  # No limit for other plans
         st.write("There is no specific contribution limit for this plan.")
 
+    # The number of assets decides which fields the form shows, so it stays outside the form
+    num_assets = st.number_input("Enter number of assets in your portfolio:", min_value=1, max_value=10)
+
+    with st.form("inputs"):
+        current_savings = st.number_input("Enter current savings:", min_value=0.0, format="%.2f")
+        # The label must not depend on the plan type chosen outside the form, or switching plans would create
+        # a new widget and reset the value; the contribution limit is shown above the form instead
+        annual_savings = st.number_input("Enter annual savings:", min_value=0.0, format="%.2f", key="annual_savings")
+        inflation_rate = st.number_input("Enter inflation rate (as a percentage):", min_value=0.0,
+                                         max_value=100.0) / 100
+        current_age = st.number_input("Enter current age:", min_value=0, max_value=120)
+        retirement_age = st.number_input("Enter desired retirement age:", min_value=0, max_value=120)
+
+        asset_inputs = []
+        for i in range(int(num_assets)):
+            asset_name = st.text_input(f"Enter asset name for asset {i + 1}:")
+            proportion = st.number_input(f"Enter proportion for asset {i + 1} (as a decimal, e.g., 0.07):",
+                                         min_value=0.0, max_value=1.0)
+            expected_return = st.number_input(f"Enter expected return for asset {i + 1} (as a percentage):",
+                                              min_value=-100.0, max_value=100.0) / 100
+            std_dev = st.number_input(f"Enter standard deviation for asset {i + 1} (as a percentage):",
+                                      min_value=0.0, max_value=100.0) / 100
+            asset_inputs.append((asset_name, proportion, expected_return, std_dev))
+
+        submitted = st.form_submit_button("Compute")
+
+    # Keep showing results on later reruns, e.g. when one of the analysis buttons is pressed
+    if submitted:
+        st.session_state["inputs_submitted"] = True
+    if not st.session_state.get("inputs_submitted", False):
+        return None
+
     # Ensure Annual Savings do not exceed the maximum contribution limit for Roth IRA
-    annual_savings = st.number_input(f"Enter annual savings (up to {max_contribution}):", min_value=0.0, format="%.2f")
     if annual_savings > max_contribution:
         st.warning(f"Annual savings cannot exceed the limit of ${max_contribution} for the selected plan.")
         return None
 
-    inflation_rate = st.number_input("Enter inflation rate (as a percentage):", min_value=0.0, max_value=100.0) / 100
-    current_age = st.number_input("Enter current age:", min_value=0, max_value=120)
-    retirement_age = st.number_input("Enter desired retirement age:", min_value=0, max_value=120)
-
-    num_assets = st.number_input("Enter number of assets in your portfolio:", min_value=1, max_value=10)
+    # Only assets with a name are added to the portfolio
+    assets = [asset for asset in asset_inputs if asset[0]]
+    total_proportion = sum(asset[1] for asset in assets)
+    if total_proportion > 1.0:
+        st.warning("Total proportion cannot exceed 1.0. Please enter valid proportions.")
+        return None
 
-    assets = []
-    total_proportion = 0.0  # Initialize total proportion
+    return current_savings, annual_savings, inflation_rate, current_age, retirement_age, assets, plan_type
 
-    for i in range(int(num_assets)):
-        asset_name = st.text_input(f"Enter asset name for asset {i + 1}:")
 
-        if asset_name:  # Proceed only if asset name is provided
-            # Input for asset proportion with validation
-            proportion = st.number_input(f"Enter proportion for {asset_name} (as a decimal, e.g., 0.07):",
-                                         min_value=0.0, max_value=1.0)
-            while total_proportion + proportion > 1.0:
-                st.warning("Total proportion cannot exceed 1.0. Please enter a valid proportion.")
-                proportion = st.number_input(f"Re-enter proportion for {asset_name} (as a decimal, e.g., 0.07):",
-                                             min_value=0.0, max_value=1.0)
+def create_retirement_plan(plan_type, current_savings, annual_savings, inflation_rate, current_age, retirement_age,
+                           assets, seed: Optional[int] = None):
+    """
+    Create the appropriate retirement plan for the selected plan type and add its assets
+    """
+    if plan_type == 'Roth':
+        calculator = RothRetirementPlan(current_savings, annual_savings, inflation_rate, current_age, retirement_age,
+                                        seed)
+    elif plan_type == 'Qualified':
+        calculator = QualifiedAnnuityPlan(current_savings, annual_savings, inflation_rate, current_age, retirement_age,
+                                          seed)
+    else:
+        calculator = NonQualifiedAnnuityPlan(current_savings, annual_savings, inflation_rate, current_age,
+                                             retirement_age, seed)
 
-            expected_return = st.number_input(f"Enter expected return for {asset_name} (as a percentage):",
-                                              min_value=-100.0, max_value=100.0) / 100
-            std_dev = st.number_input(f"Enter standard deviation for {asset_name} (as a percentage):", min_value=0.0,
-                                      max_value=100.0) / 100
+    for asset in assets:
+        calculator.add_assets(asset[0], asset[1], asset[2], asset[3])
+    return calculator
 
-            # Add asset to the list
-            assets.append((asset_name, proportion, expected_return, std_dev))
-            total_proportion += proportion  # Update total proportion
 
-            if total_proportion >= 1.0:
-                st.warning("You have fully allocated your investment. No other assets can be added.")
-                break  # Stop adding more assets if the total proportion is 1.0 or more
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES)
+def simulate_retirement_savings(plan_type, current_savings, annual_savings, inflation_rate, current_age,
+                                retirement_age, assets, num_simulations, seed) -> np.ndarray:
+    """
+    Run the Monte Carlo simulation, cached on the plan inputs and the seed across Streamlit reruns.
+    The same inputs and seed always give the same outcomes; change the seed to draw new ones.
+    """
+    calculator = create_retirement_plan(plan_type, current_savings, annual_savings, inflation_rate, current_age,
+                                        retirement_age, assets, seed)
+    return calculator.monte_carlo_simulation(num_simulations)
 
-    return current_savings, annual_savings, inflation_rate, current_age, retirement_age, assets, plan_type
 
 def plot_retirement_savings(current_savings, inflation_rate, current_age, assets, plan_type):
     """
@@ -256,35 +377,34 @@ def plot_retirement_savings(current_savings, inflation_rate, current_age, assets
     years_range = np.arange(1, 41)  # Range for years to retirement (1 to 40 years)
     annuity_range = np.arange(1000, 20001, 5000)  # Range for annual savings (from $1,000 to $20,000)
 
-    savings_results = np.zeros((len(years_range), len(annuity_range)))  # To hold the results
+    # The weighted return does not depend on the years or annual savings, so compute it once
+    retirement_plan = RetirementPlan(current_savings, 0.0, inflation_rate, current_age, current_age)
+    for asset in assets:
+        retirement_plan.add_assets(asset[0], asset[1], asset[2], asset[3])
+    weighted_return = retirement_plan.calculate_weighted_return()
 
-    # Calculate total retirement savings for varying years and annuity
-    for j, annual_savings in enumerate(annuity_range):
-        total_savings = []
-        for years in years_range:
-            retirement_plan = RetirementPlan(current_savings, annual_savings, inflation_rate, current_age,
-                                             current_age + years)
-            for asset in assets:
-                retirement_plan.add_assets(asset[0], asset[1], asset[2], asset[3])
-            future_value_current, future_value_annuity, total_retirement_savings = retirement_plan.calculate_total_retirement_savings()
-            total_savings.append(total_retirement_savings)
-        savings_results[:, j] = total_savings
+    # Calculate total retirement savings over the whole (years, annuity) grid at once
+    savings_results = total_fv(float(current_savings), annuity_range.astype(np.float64), weighted_return,
+                               years_range[:, np.newaxis].astype(np.float64))
 
-    # Plotting the line graph
-    plt.figure(figsize=(12, 8))
+    # Plotting the line graph. The figure is built per render because Matplotlib figures are not thread-safe
+    # and Streamlit serves each session from its own thread.
+    fig, ax = plt.subplots(figsize=(12, 8))
 
-    for j in range(len(annuity_range)):
-        plt.plot(years_range, savings_results[:, j], label=f'Annual Savings: ${annuity_range[j]:,.0f}')
+    # One line per annual savings amount, drawn from the columns of the result grid in a single call
+    lines = ax.plot(years_range, savings_results)
 
-    plt.title('Effect of Years to Retirement and Annual Savings on Total Retirement Savings')
-    plt.xlabel('Years to Retirement')
-    plt.ylabel('Total Retirement Savings ($)')
-    plt.legend(title='Annual Savings', bbox_to_anchor=(1.05, 1), loc='upper left')
-    plt.grid()
-    plt.tight_layout()
+    ax.set_title('Effect of Years to Retirement and Annual Savings on Total Retirement Savings')
+    ax.set_xlabel('Years to Retirement')
+    ax.set_ylabel('Total Retirement Savings ($)')
+    ax.legend(lines, [f'Annual Savings: ${amount:,.0f}' for amount in annuity_range],
+              title='Annual Savings', bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax.grid()
+    fig.tight_layout()
 
-    # Show the plot in Streamlit
-    st.pyplot(plt)
+    # Show the plot in Streamlit, then release the figure from pyplot's registry
+    st.pyplot(fig)
+    plt.close(fig)
 
 
 def main():
@@ -297,18 +417,9 @@ def main():
 
     current_savings, annual_savings, inflation_rate, current_age, retirement_age, assets, plan_type = user_input
 
-    # Create the appropriate retirement plan based on user selection
-    if plan_type == 'Roth':
-        calculator = RothRetirementPlan(current_savings, annual_savings, inflation_rate, current_age, retirement_age)
-    elif plan_type == 'Qualified':
-        calculator = QualifiedAnnuityPlan(current_savings, annual_savings, inflation_rate, current_age, retirement_age)
-    else:
-        calculator = NonQualifiedAnnuityPlan(current_savings, annual_savings, inflation_rate, current_age,
-                                             retirement_age)
-
-    # Add assets to the plan
-    for asset in assets:
-        calculator.add_assets(asset[0], asset[1], asset[2], asset[3])
+    assets = tuple(assets)
+    plan_inputs = (plan_type, current_savings, annual_savings, inflation_rate, current_age, retirement_age, assets)
+    calculator = create_retirement_plan(*plan_inputs)
 
     # Calculate total retirement savings
     future_value_current, future_value_annuity, total_retirement_savings = calculator.calculate_total_retirement_savings()
@@ -322,8 +433,11 @@ def main():
     # Monte Carlo simulation results
     num_simulations = st.number_input("Number of simulations for Monte Carlo analysis:", min_value=1000,
                                       max_value=100000, value=10000)
+    # Results are cached per seed, so the same seed reproduces the same outcomes
+    seed = st.number_input("Random seed for Monte Carlo analysis:", min_value=0, value=0)
     if st.button("Run Monte Carlo Simulation"):
-        calculator.monte_carlo_summary(num_simulations)
+        outcomes = simulate_retirement_savings(*plan_inputs, num_simulations, seed)
+        calculator.monte_carlo_summary(num_simulations, outcomes)
 
     # Plot the effect of years and annuity on total retirement savings
     if st.button("Visualize Effect of Years and Annuity"):